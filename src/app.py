@@ -8,6 +8,7 @@ import streamlit as st
 from streamlit.delta_generator import DeltaGenerator
 
 from bai.bai import (
+    API_URL,
     Preset,
     get_quick_match_data,
     get_quick_win_rate,
@@ -21,6 +22,10 @@ from bai.bai import (
     get_battle_details,
     get_map_win_rate,
     get_player_data,
+    get_skill_history,
+    get_time_series,
+    get_form,
+    get_map_form,
 )
 
 plt.rcParams["figure.figsize"] = (10, 10)
@@ -52,7 +57,46 @@ def player_tab_controller(
     player_data_df: pd.DataFrame = get_player_data(df, player)
     if not player_data_df.empty:
         # st.dataframe(player_data_df)
-        st.area_chart(data=player_data_df, x="startTime", y="skill")
+        st.area_chart(data=get_skill_history(player_data_df), x="startTime", y="skill")
+
+    # Recent form, only the new games are processed on reruns
+    form_key = f"form_{player}_{preset}_{season0}"
+    form_df: pd.DataFrame = get_form(df, player, form_df=st.session_state.get(form_key))
+    st.session_state[form_key] = form_df
+    if not form_df.empty:
+        last_game = form_df.iloc[-1]
+        col_games, col_days, col_streak = st.columns(3)
+        col_games.metric("Win rate last 10 games", f"{last_game['rollingWinRate']:.0%}")
+        col_days.metric("Win rate last 30 days", f"{last_game['recentWinRate']:.0%}")
+        col_streak.metric(
+            "Streak",
+            f"{abs(last_game['streak'])} {'wins' if last_game['streak'] > 0 else 'losses'}",
+        )
+        st.line_chart(
+            data=get_time_series(form_df, ["rollingWinRate", "recentWinRate"]),
+            x="startTime",
+            y=["rollingWinRate", "recentWinRate"],
+        )
+        st.dataframe(
+            get_map_form(form_df),
+            column_config={
+                "Map.fileName": "Map form",
+                "mapGames": st.column_config.NumberColumn(
+                    "Games", help="Number of games played on the map", format="%d 🎮"
+                ),
+                "mapWins": None,
+                "mapRollingWinRate": st.column_config.NumberColumn(
+                    "Last 10 games",
+                    help="Win rate of the last 10 games on the map",
+                    format="%.2f",
+                ),
+                "mapRecentWinRate": st.column_config.NumberColumn(
+                    "Last 30 days",
+                    help="Win rate of the last 30 days on the map",
+                    format="%.2f",
+                ),
+            },
+        )
 
     col_best, col_worst, col_fraction = st.columns(3)
 
@@ -197,7 +241,7 @@ def battle_tab_controller(
     map_name = team1_df["Map.fileName"].iloc[0]  # lobby 0
     image_col, title_col = st.columns([1, 5], gap="small")
     with image_col:
-        st.image(f"https://api.bar-rts.com/maps/{map_name}/texture-mq.jpg")
+        st.image(f"{API_URL}/maps/{map_name}/texture-mq.jpg")
     with title_col:
         st.subheader(f"Map: {map_name}")
 
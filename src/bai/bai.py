@@ -1,13 +1,23 @@
+from contextlib import contextmanager
 from datetime import datetime
+import hashlib
+import os
 from enum import auto, StrEnum
 import re
-from typing import Any, List, Literal
+import time
+from typing import Any, Iterator, List, Literal
 from matplotlib.figure import Figure
 
 from requests_cache import CachedSession, NEVER_EXPIRE
 
+try:
+    import fcntl
+except ImportError:  # Windows, fetches are not locked across processes
+    fcntl = None
+
 from urllib.parse import quote
 
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
@@ -16,6 +26,17 @@ from streamlit.delta_generator import DeltaGenerator
 
 plt.rcParams["figure.figsize"] = (10, 10)
 
+# Base url of the Beyond All Reason API, can point to a local stand-in
+API_URL: str = os.environ.get("BAI_API_URL", "https://api.bar-rts.com")
+
+# Directory of the request caches, a volume shared by all the replicas to share them
+CACHE_DIR: str = os.environ.get("BAI_CACHE_DIR", "")
+# Number of lock files the urls are spread over
+CACHE_LOCKS: int = 256
+# Seconds to wait for the API, and for another replica fetching the same url
+FETCH_TIMEOUT: int = 30
+LOCK_TIMEOUT: int = 35
+
 
 class Preset(StrEnum):
     duel = auto()
@@ -24,25 +45,75 @@ class Preset(StrEnum):
     all = auto()
 
 
+def _cached_session(name: str, expire_after: int) -> CachedSession:
+    """Get a session cached in sqlite, safe to share between processes"""
+    return CachedSession(
+        os.path.join(CACHE_DIR, name),
+        backend="sqlite",
+        expire_after=expire_after,
+        # Readers are not blocked by a writer, writers wait for each other
+        wal=True,
+        timeout=30,
+    )
+
+
+@contextmanager
+def _fetch_lock(url: str) -> Iterator[None]:
+    """Lock the url across the replicas sharing the cache, so only one of them fetches it
+
+    Stops waiting for the lock after LOCK_TIMEOUT seconds and goes on unlocked.
+    """
+    if fcntl is None or not CACHE_DIR:
+        yield
+        return
+    lock_dir = os.path.join(CACHE_DIR, "cache_locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_id = int(hashlib.sha1(url.encode()).hexdigest(), 16) % CACHE_LOCKS
+    with open(os.path.join(lock_dir, f"{lock_id}.lock"), "a") as lock_file:
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        locked = False
+        while not locked and time.monotonic() < deadline:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except BlockingIOError:
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if locked:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _get_json(session: CachedSession, url: str) -> Any:
+    """Get the json from the cache, or fetch it once across processes"""
+    response = session.get(url, only_if_cached=True)
+    if response.status_code == 504:  # Not cached or expired
+        with _fetch_lock(url):
+            # Cached by another process while waiting for the lock
+            response = session.get(url, timeout=FETCH_TIMEOUT)
+    return response.json()
+
+
 def get_data(url: str):
     """Get data from the API and cache it"""
     # print(f"Getting data from {url}")
-    session = CachedSession("bar_cache", backend="sqlite", expire_after=NEVER_EXPIRE)
-    data = session.get(url).json()
+    session = _cached_session("bar_cache", NEVER_EXPIRE)
+    data = _get_json(session, url)
     return data
 
 
 def get_fresh_data(url: str):
     """Get data from the API and cache it for 60 seconds"""
     # print(f"Getting data from {url}")
-    session = CachedSession("short_cache", backend="sqlite", expire_after=960)
-    data = session.get(url).json()
+    session = _cached_session("short_cache", 960)
+    data = _get_json(session, url)
     return data
 
 
 def get_user_name(user_id: int) -> Any | Literal[""]:
     """Get the user name from the user id"""
-    name_list = get_data("https://api.bar-rts.com/cached-users")
+    name_list = get_data(f"{API_URL}/cached-users")
     user_name = ""
     for user in name_list:
         if user["id"] == user_id:
@@ -52,7 +123,7 @@ def get_user_name(user_id: int) -> Any | Literal[""]:
 
 def get_user_id(user_name: str) -> Any | Literal[""]:
     """Get the user id from the user name"""
-    name_list = get_data("https://api.bar-rts.com/cached-users")
+    name_list = get_data(f"{API_URL}/cached-users")
     user_id = ""
     for user in name_list:
         if user["username"] == user_name:
@@ -76,6 +147,8 @@ def process_match_data(match_details_df: pd.DataFrame) -> pd.DataFrame:
                 match = {
                     **match,
                     **{
+                        "replayId": game["id"],
+                        "preset": game["preset"],
                         "id": team["id"],
                         "userId": player["userId"],
                         "teamId": player["teamId"],
@@ -110,7 +183,7 @@ def process_match_data(match_details_df: pd.DataFrame) -> pd.DataFrame:
 
 def get_match_details(id: str) -> pd.DataFrame:
     """Get the match details for a specific match"""
-    match_details = get_data(f"https://api.bar-rts.com/replays/{id}")
+    match_details = get_data(f"{API_URL}/replays/{id}")
 
     match_details_df: pd.DataFrame = pd.json_normalize(match_details)
     match_details_df["startTime"] = pd.to_datetime(match_details_df["startTime"])
@@ -138,7 +211,7 @@ def get_match_data(
     if season0:
         date_range = f"&date=2023-06-01&date={datetime.today().strftime('%Y-%m-%d')}"
 
-    uri = f"https://api.bar-rts.com/replays?page=1&limit=9999{preset}{date_range}&hasBots=false&endedNormally=true&players="
+    uri = f"{API_URL}/replays?page=1&limit=9999{preset}{date_range}&hasBots=false&endedNormally=true&players="
 
     data = get_fresh_data(f"{uri}{quote(user)}")
 
@@ -187,7 +260,7 @@ def get_quick_match_data(
         date_range = f"&date=2023-06-01&date={datetime.today().strftime('%Y-%m-%d')}"
 
     uri: str = (
-        f"https://api.bar-rts.com/replays?page=1&limit=9999{preset}{date_range}&hasBots=false&endedNormally=true&players="
+        f"{API_URL}/replays?page=1&limit=9999{preset}{date_range}&hasBots=false&endedNormally=true&players="
     )
 
     data = get_fresh_data(f"{uri}{quote(user)}")
@@ -283,6 +356,188 @@ def get_player_data(
     return win_rate_df
 
 
+def get_time_series(
+    df: pd.DataFrame,
+    columns: List[str],
+    max_points: int = 500,
+) -> pd.DataFrame:
+    """Get the columns over time, downsampled to at most max_points"""
+    if df.empty:
+        return df
+
+    series_df: pd.DataFrame = (
+        df[["startTime", *columns]]
+        .sort_values("startTime", kind="stable")
+        .reset_index(drop=True)
+    )
+    if len(series_df) <= max_points:
+        return series_df
+
+    # Keep the lowest and highest value of each column in each time bucket, and both ends
+    buckets = pd.cut(
+        series_df["startTime"].astype("int64"),
+        bins=max(1, (max_points - 2) // (2 * len(columns))),
+        labels=False,
+    )
+    series_by_bucket = series_df[columns].groupby(buckets)
+    keep = np.unique(
+        np.concatenate(
+            [
+                series_by_bucket.idxmin().to_numpy().ravel(),
+                series_by_bucket.idxmax().to_numpy().ravel(),
+                [0, len(series_df) - 1],
+            ]
+        )
+    )
+    return series_df.loc[keep].reset_index(drop=True)
+
+
+def get_skill_history(
+    player_data_df: pd.DataFrame,
+    max_points: int = 500,
+) -> pd.DataFrame:
+    """Get the skill of the player over time, downsampled to at most max_points"""
+    return get_time_series(player_data_df, ["skill"], max_points)
+
+
+def get_form(
+    df: pd.DataFrame,
+    user: str,
+    games: int = 10,
+    days: int = 30,
+    form_df: pd.DataFrame | None = None,
+) -> pd.DataFrame:
+    """Get the rolling win rate and streaks of the player, overall and per map
+
+    Pass the previous result as form_df to only process the games played after it.
+    """
+    player_df = get_player_data(df, user)
+    if player_df.empty:
+        return player_df
+
+    player_df = player_df[["startTime", "Map.fileName", "winningTeam"]].sort_values(
+        "startTime", kind="stable"
+    )
+    if form_df is None or form_df.empty:
+        return _get_form(player_df, pd.DataFrame(), games, days)
+
+    # Only the games after the last processed one are new
+    player_df = player_df[player_df["startTime"] > form_df["startTime"].iloc[-1]]
+    if player_df.empty:
+        return form_df
+    return pd.concat(
+        [form_df, _get_form(player_df, form_df, games, days)], ignore_index=True
+    )
+
+
+def _get_form(
+    new_df: pd.DataFrame,
+    history_df: pd.DataFrame,
+    games: int,
+    days: int,
+) -> pd.DataFrame:
+    """Get the form of new games, continuing from the already processed history"""
+    form_df: pd.DataFrame = new_df.reset_index(drop=True)
+    form_df["winningTeam"] = form_df["winningTeam"].astype(bool)
+    won = form_df["winningTeam"].astype(int)
+    maps = form_df["Map.fileName"]
+
+    # Expanding counts, carried over from the history
+    if history_df.empty:
+        total_games, total_wins, last_streak = 0, 0, 0
+        map_totals = pd.DataFrame(columns=["mapGames", "mapWins"])
+    else:
+        total_games = history_df["games"].iloc[-1]
+        total_wins = history_df["wins"].iloc[-1]
+        last_streak = history_df["streak"].iloc[-1]
+        map_totals = history_df.groupby("Map.fileName")[["mapGames", "mapWins"]].last()
+
+    form_df["games"] = total_games + np.arange(1, len(form_df) + 1)
+    form_df["wins"] = total_wins + won.cumsum()
+    form_df["winRate"] = form_df["wins"] / form_df["games"]
+
+    map_base = map_totals.reindex(maps).fillna(0).astype(int).to_numpy()
+    form_df["mapGames"] = map_base[:, 0] + won.groupby(maps).cumcount().to_numpy() + 1
+    form_df["mapWins"] = map_base[:, 1] + won.groupby(maps).cumsum().to_numpy()
+
+    # Rolling win rate over the last n games: wins now minus wins n games ago
+    context_df = form_df
+    map_context_df = form_df
+    if not history_df.empty:
+        context_df = pd.concat([history_df.tail(games), form_df])
+        map_context_df = pd.concat(
+            [history_df.groupby("Map.fileName").tail(games), form_df]
+        )
+    wins_at = pd.Series(
+        context_df["wins"].to_numpy(), index=context_df["games"].to_numpy()
+    )
+    wins_before = wins_at.reindex(form_df["games"] - games, fill_value=0).to_numpy()
+    form_df["rollingWinRate"] = (form_df["wins"] - wins_before) / form_df["games"].clip(
+        upper=games
+    )
+
+    map_wins_at = pd.Series(
+        map_context_df["mapWins"].to_numpy(),
+        index=pd.MultiIndex.from_arrays(
+            [map_context_df["Map.fileName"], map_context_df["mapGames"]]
+        ),
+    )
+    map_wins_before = map_wins_at.reindex(
+        pd.MultiIndex.from_arrays([maps, form_df["mapGames"] - games]), fill_value=0
+    ).to_numpy()
+    form_df["mapRollingWinRate"] = (form_df["mapWins"] - map_wins_before) / form_df[
+        "mapGames"
+    ].clip(upper=games)
+
+    # Rolling win rate over the last n days, only the history in the window is needed
+    window_df = form_df[["startTime", "Map.fileName"]].assign(won=won)
+    if not history_df.empty:
+        since = form_df["startTime"].iloc[0] - pd.Timedelta(days=days)
+        recent_df = history_df.loc[
+            history_df["startTime"] > since,
+            ["startTime", "Map.fileName", "winningTeam"],
+        ]
+        window_df = pd.concat(
+            [
+                recent_df.assign(won=recent_df["winningTeam"].astype(int)).drop(
+                    columns="winningTeam"
+                ),
+                window_df,
+            ],
+            ignore_index=True,
+        )
+    recent_win_rate = window_df.rolling(f"{days}D", on="startTime")["won"].mean()
+    form_df["recentWinRate"] = recent_win_rate.to_numpy()[-len(form_df) :]
+    # groupby keeps the game order within each map, map by map
+    map_order = window_df.sort_values("Map.fileName", kind="stable").index
+    map_recent_win_rate = pd.Series(
+        window_df.groupby("Map.fileName")
+        .rolling(f"{days}D", on="startTime")["won"]
+        .mean()
+        .to_numpy(),
+        index=map_order,
+    ).sort_index()
+    form_df["mapRecentWinRate"] = map_recent_win_rate.to_numpy()[-len(form_df) :]
+
+    # Streaks: positive for wins, negative for losses
+    run = (form_df["winningTeam"] != form_df["winningTeam"].shift()).cumsum()
+    streak = form_df["winningTeam"].groupby(run).cumcount() + 1
+    carry = (run == 1) & (form_df["winningTeam"] == (last_streak > 0))
+    streak += carry * abs(last_streak)
+    form_df["streak"] = streak.where(form_df["winningTeam"], -streak)
+
+    return form_df
+
+
+def get_map_form(form_df: pd.DataFrame) -> pd.DataFrame:
+    """Get the latest form of the player for each map"""
+    if form_df.empty:
+        return form_df
+    return form_df.groupby(["Map.fileName"])[
+        ["mapGames", "mapWins", "mapRollingWinRate", "mapRecentWinRate"]
+    ].last()
+
+
 def get_fractions_win_rate(df: pd.DataFrame, user: str) -> pd.Series:
     return (
         df.query(f"userId == {get_user_id(user)}")
@@ -312,7 +567,7 @@ def get_best_teammates(df: pd.DataFrame, user: str, min_games: int = 5) -> pd.Da
 
 def get_battle_list() -> pd.DataFrame:
     """Get the list of battles"""
-    battles_json = get_fresh_data("https://api.bar-rts.com/battles")
+    battles_json = get_fresh_data(f"{API_URL}/battles")
     return pd.json_normalize(battles_json)
 
 
@@ -0,0 +1,237 @@
+# Parquet export of the processed match data for offline analysis
+#
+# The dataset is partitioned by preset and month, so reads filtered by date
+# range only open the matching partitions, and map and player filters are
+# pushed down to the parquet row groups. Each game of a player is stored once,
+# however many of the exported players played it.
+#
+#   python -m bai.export write "[8D]" --preset team --path data/matches
+#   python -m bai.export read --path data/matches --start 2024-01-01 --map tempest_v3
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+from datetime import datetime
+from typing import List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from bai.bai import Preset, get_match_data, process_match_data
+
+# Stable schema of the dataset, independent of what the API returned
+SCHEMA: pa.Schema = pa.schema(
+    [
+        ("replayId", pa.string()),
+        ("id", pa.int64()),
+        ("userId", pa.int64()),
+        ("teamId", pa.int64()),
+        ("allyTeamId", pa.int64()),
+        ("name", pa.string()),
+        ("faction", pa.string()),
+        ("rank", pa.int64()),
+        ("skillUncertainty", pa.float64()),
+        ("skill", pa.float64()),
+        ("startPos.x", pa.float64()),
+        ("startPos.y", pa.float64()),
+        ("startPos.z", pa.float64()),
+        ("winningTeam", pa.bool_()),
+        ("Map.fileName", pa.string()),
+        ("Map.scriptName", pa.string()),
+        ("durationMs", pa.int64()),
+        ("startTime", pa.timestamp("ms", tz="UTC")),
+        ("preset", pa.string()),
+        ("month", pa.string()),
+    ]
+)
+PARTITIONING: ds.Partitioning = ds.partitioning(
+    pa.schema([SCHEMA.field("preset"), SCHEMA.field("month")]), flavor="hive"
+)
+
+
+def to_match_table(df: pd.DataFrame) -> pa.Table:
+    """Convert the processed match data to a table with the dataset schema"""
+    frame: pd.DataFrame = df.assign(
+        startTime=pd.to_datetime(df["startTime"], utc=True),
+        month=pd.to_datetime(df["startTime"], utc=True).dt.strftime("%Y-%m"),
+    ).reindex(columns=SCHEMA.names)
+    for field in SCHEMA:
+        if pa.types.is_integer(field.type):
+            frame[field.name] = frame[field.name].astype("Int64")
+    return pa.Table.from_pandas(
+        frame.sort_values("startTime", kind="stable"),
+        schema=SCHEMA,
+        preserve_index=False,
+    )
+
+
+def export_match_data(df: pd.DataFrame, path: str) -> None:
+    """Write the processed match data to a parquet dataset partitioned by preset and month
+
+    The partitions written are merged with the games already in them, so games shared
+    by several exports are stored once. The merged files are written aside first and
+    only replace the old ones once complete, so a failed export loses no games.
+    """
+    if df.empty:
+        return
+    table = to_match_table(df)
+
+    if os.path.isdir(path):
+        partitions = table.select(["preset", "month"]).to_pandas().drop_duplicates()
+        expression = None
+        for preset, month in partitions.itertuples(index=False):
+            partition = (ds.field("preset") == preset) & (ds.field("month") == month)
+            expression = partition if expression is None else expression | partition
+        existing = ds.dataset(
+            path, format="parquet", schema=SCHEMA, partitioning=PARTITIONING
+        ).to_table(filter=expression)
+        table = pa.concat_tables([existing, table])
+
+    # The latest export of a player in a game wins
+    matches_df: pd.DataFrame = (
+        table.to_pandas()
+        .drop_duplicates(["replayId", "userId"], keep="last")
+        .sort_values("startTime", kind="stable")
+    )
+    os.makedirs(path, exist_ok=True)
+    # Directories starting with "." are skipped when reading the dataset
+    staging_dir = tempfile.mkdtemp(prefix=".export-", dir=path)
+    try:
+        ds.write_dataset(
+            pa.Table.from_pandas(matches_df, schema=SCHEMA, preserve_index=False),
+            staging_dir,
+            format="parquet",
+            partitioning=PARTITIONING,
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        )
+        for partition_dir, _, files in os.walk(staging_dir):
+            if not files:
+                continue
+            target_dir = os.path.join(path, os.path.relpath(partition_dir, staging_dir))
+            os.makedirs(target_dir, exist_ok=True)
+            old_files = glob.glob(os.path.join(target_dir, "*.parquet"))
+            for file in files:
+                os.replace(
+                    os.path.join(partition_dir, file), os.path.join(target_dir, file)
+                )
+            for old_file in old_files:
+                os.remove(old_file)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _utc(value: datetime) -> pd.Timestamp:
+    """Convert a datetime to UTC, naive ones are taken as UTC"""
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        return timestamp.tz_localize("UTC")
+    return timestamp.tz_convert("UTC")
+
+
+def read_match_data(
+    path: str,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    maps: List[str] | None = None,
+    players: List[str] | None = None,
+    presets: List[Preset] | None = None,
+) -> pd.DataFrame:
+    """Read the match data from a parquet dataset, only opening the partitions needed"""
+    dataset = ds.dataset(
+        path, format="parquet", schema=SCHEMA, partitioning=PARTITIONING
+    )
+
+    filters: List[ds.Expression] = []
+    if presets:
+        filters.append(ds.field("preset").isin([preset.name for preset in presets]))
+    if start is not None:
+        # Partitions are by UTC month
+        start = _utc(start)
+        filters.append(ds.field("month") >= start.strftime("%Y-%m"))
+        filters.append(
+            ds.field("startTime") >= pa.scalar(start, SCHEMA.field("startTime").type)
+        )
+    if end is not None:
+        end = _utc(end)
+        filters.append(ds.field("month") <= end.strftime("%Y-%m"))
+        filters.append(
+            ds.field("startTime") < pa.scalar(end, SCHEMA.field("startTime").type)
+        )
+    if maps:
+        filters.append(ds.field("Map.fileName").isin(maps))
+    if players:
+        filters.append(ds.field("name").isin(players))
+
+    expression = None
+    for expression_filter in filters:
+        expression = (
+            expression_filter if expression is None else expression & expression_filter
+        )
+
+    matches_df: pd.DataFrame = dataset.to_table(filter=expression).to_pandas()
+    return matches_df
+
+
+class _Progress:
+    """Progress of the API calls on the terminal, in place of a streamlit progress bar"""
+
+    def progress(self, value: float, text: str = "") -> None:
+        print(f"\r{value:4.0%} {text}", end="", file=sys.stderr, flush=True)
+
+
+def main() -> None:
+    """Command line entry point of the export"""
+    parser = argparse.ArgumentParser(description="Parquet export of the match data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    write_parser = subparsers.add_parser("write", help="export the games of players")
+    write_parser.add_argument("players", nargs="+", help="player names")
+    write_parser.add_argument("--path", required=True, help="dataset directory")
+    write_parser.add_argument(
+        "--preset", default="all", choices=[preset.name for preset in Preset]
+    )
+    write_parser.add_argument(
+        "--season0", action="store_true", help="only games after June 1st, 2023"
+    )
+
+    read_parser = subparsers.add_parser("read", help="read games from the dataset")
+    read_parser.add_argument("--path", required=True, help="dataset directory")
+    read_parser.add_argument("--start", type=datetime.fromisoformat)
+    read_parser.add_argument("--end", type=datetime.fromisoformat)
+    read_parser.add_argument("--map", action="append", dest="maps")
+    read_parser.add_argument("--player", action="append", dest="players")
+    read_parser.add_argument(
+        "--preset",
+        action="append",
+        dest="presets",
+        type=Preset,
+        choices=[Preset.duel, Preset.team, Preset.ffa],
+    )
+    read_parser.add_argument("--csv", help="write the games to a csv file")
+
+    args = parser.parse_args()
+    if args.command == "write":
+        for player in args.players:
+            df: pd.DataFrame = process_match_data(
+                get_match_data(_Progress(), player, Preset(args.preset), args.season0)
+            )
+            print(file=sys.stderr)
+            export_match_data(df, args.path)
+            print(f"{player}: {len(df.index)} rows exported")
+        return
+
+    matches_df = read_match_data(
+        args.path, args.start, args.end, args.maps, args.players, args.presets
+    )
+    if args.csv:
+        matches_df.to_csv(args.csv, index=False)
+    print(matches_df)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+# Load test for the Beyond All Information streamlit app
+#
+# Runs src/app.py headless with Streamlit's app testing API against a local
+# stand-in for api.bar-rts.com and reports latency, throughput, CPU and RSS.
+#
+#   python -m bai.loadtest --sessions 8 --runs 5
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from multiprocessing.sharedctypes import Synchronized
+from typing import Any, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+APP_PATH: Path = Path(__file__).resolve().parents[1] / "app.py"
+
+MAPS: List[str] = [
+    "all_that_glitters_v2.2",
+    "supreme_isthmus_v1.6.4",
+    "red_comet_remake_1.8",
+    "eight_horses_1.5",
+    "tempest_v3",
+    "comet_catcher_remake_1.8",
+]
+FACTIONS: List[str] = ["Armada", "Cortex"]
+
+# Share of sessions per game preset, most viewers look at team games
+PRESET_MIX: Dict[str, float] = {"team": 0.7, "duel": 0.2, "ffa": 0.05, "all": 0.05}
+
+
+class StubApi:
+    """Deterministic stand-in for the Beyond All Reason API"""
+
+    def __init__(
+        self,
+        players: int = 50,
+        max_games: int = 300,
+        seed: int = 0,
+        requests: Synchronized | None = None,
+    ):
+        rng = random.Random(seed)
+        self.players: List[Dict[str, Any]] = [
+            {"id": 1000 + index, "username": f"player{index}"}
+            for index in range(players)
+        ]
+        # A few veterans with long histories, most players with short ones
+        self.games: List[int] = [
+            int(min(max_games, rng.paretovariate(1.2) * 10)) for _ in range(players)
+        ]
+        self.start: datetime = datetime(2023, 6, 1)
+        # Shared with the process serving the API
+        self.requests: Synchronized = requests or multiprocessing.Value("i", 0)
+
+    def _players(self, rng: random.Random, owner: int, size: int) -> List[int]:
+        others = [index for index in range(len(self.players)) if index != owner]
+        return [owner, *rng.sample(others, 2 * size - 1)]
+
+    def replay(self, replay_id: str) -> Dict[str, Any]:
+        """Get the details of a replay, generated from its id"""
+        owner, game = (int(part) for part in replay_id.split("-"))
+        rng = random.Random(replay_id)
+        size = rng.choice(
+            [size for size in (1, 2, 4, 8) if 2 * size <= len(self.players)]
+        )
+        players = self._players(rng, owner, size)
+        winning_team = rng.randrange(2)
+        map_name = rng.choice(MAPS)
+        ally_teams = []
+        for ally_team in range(2):
+            ally_teams.append(
+                {
+                    "id": 2 * game + ally_team,
+                    "winningTeam": ally_team == winning_team,
+                    "Players": [
+                        {
+                            "userId": self.players[player]["id"],
+                            "teamId": ally_team * size + slot,
+                            "allyTeamId": ally_team,
+                            "name": self.players[player]["username"],
+                            "faction": rng.choice(FACTIONS),
+                            "rank": rng.randrange(7),
+                            "skillUncertainty": round(rng.uniform(1, 8), 2),
+                            "skill": f"[{rng.uniform(5, 50):.2f}]",
+                            "startPos": {"x": rng.randrange(8192), "z": 0},
+                        }
+                        for slot, player in enumerate(
+                            players[ally_team * size : (ally_team + 1) * size]
+                        )
+                    ],
+                }
+            )
+        return {
+            "id": replay_id,
+            "startTime": (self.start + timedelta(hours=game * 7)).isoformat() + "Z",
+            "durationMs": rng.randrange(600_000, 3_600_000),
+            "preset": "duel" if size == 1 else "team",
+            "Map": {"fileName": map_name, "scriptName": map_name.replace("_", " ")},
+            "AllyTeams": ally_teams,
+        }
+
+    def replays(self, username: str) -> Dict[str, Any]:
+        """Get the replays list of a player"""
+        owner = next(
+            (
+                index
+                for index, player in enumerate(self.players)
+                if player["username"] == username
+            ),
+            None,
+        )
+        if owner is None:
+            return {"data": []}
+        return {
+            "data": [
+                self.replay(f"{owner}-{game}") for game in range(self.games[owner])
+            ]
+        }
+
+    def battles(self) -> List[Dict[str, Any]]:
+        """Get the list of running battles"""
+        rng = random.Random(int(time.time()) // 60)
+        size = min(4, len(self.players) // 2)
+        players = rng.sample(range(len(self.players)), 2 * size)
+        return [
+            {
+                "title": "Stub battle",
+                "mapFileName": rng.choice(MAPS),
+                "players": [
+                    {
+                        "teamId": slot // size,
+                        "username": self.players[player]["username"],
+                        "userId": self.players[player]["id"],
+                        "skill": f"[{rng.uniform(5, 50):.2f}]",
+                        "gameStatus": "playing",
+                    }
+                    for slot, player in enumerate(players)
+                ],
+            }
+        ]
+
+    def handle(self, url: str) -> Any:
+        """Route a request url to its response"""
+        with self.requests.get_lock():
+            self.requests.value += 1
+        parsed = urlparse(url)
+        path = parsed.path.strip("/").split("/")
+        if path == ["cached-users"]:
+            return self.players
+        if path == ["battles"]:
+            return self.battles()
+        if path == ["replays"]:
+            return self.replays(parse_qs(parsed.query).get("players", [""])[0])
+        if len(path) == 2 and path[0] == "replays":
+            return self.replay(path[1])
+        return None
+
+
+def serve_stub_api(api: StubApi, latency: float = 0.0) -> ThreadingHTTPServer:
+    """Serve the stub API on a free local port in a background thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            time.sleep(latency)
+            body = api.handle(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            payload = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _serve_stub_process(
+    players: int,
+    max_games: int,
+    seed: int,
+    requests: Synchronized,
+    latency: float,
+    port: Synchronized,
+    stop: Any,
+) -> None:
+    """Serve the stub API until stopped, in its own process"""
+    server = serve_stub_api(StubApi(players, max_games, seed, requests), latency)
+    port.value = server.server_port
+    stop.wait()
+    server.shutdown()
+
+
+def current_rss_mb() -> float:
+    """Get the resident set size of this process in MB"""
+    with open("/proc/self/statm") as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def run_session(
+    api: StubApi,
+    runs: int,
+    seed: int,
+    timeout: float,
+) -> List[float]:
+    """Simulate a viewer: open the app for a player, then switch presets"""
+    from streamlit.testing.v1 import AppTest
+
+    rng = random.Random(seed)
+    player = rng.choice(api.players)["username"]
+    app = AppTest.from_file(str(APP_PATH), default_timeout=timeout)
+    app.query_params["player"] = player
+
+    latencies: List[float] = []
+    for run in range(runs):
+        if run > 0:
+            preset = rng.choices(list(PRESET_MIX), weights=list(PRESET_MIX.values()))
+            app.sidebar.selectbox[0].select(preset[0])
+        start = time.perf_counter()
+        app.run()
+        latencies.append(time.perf_counter() - start)
+        if app.exception:
+            raise RuntimeError(f"Session {seed} ({player}) failed: {app.exception}")
+    return latencies
+
+
+def load_test(
+    sessions: int = 4,
+    runs: int = 3,
+    players: int = 50,
+    max_games: int = 300,
+    latency: float = 0.0,
+    timeout: float = 300.0,
+    seed: int = 0,
+    cache_dir: str | None = None,
+) -> Dict[str, float]:
+    """Run concurrent sessions against the app and collect the statistics
+
+    The request caches go to cache_dir, or the app's BAI_CACHE_DIR when not given.
+    """
+    api = StubApi(players, max_games, seed)
+
+    # The stub runs in its own process, so the CPU and RSS are only the app's
+    port = multiprocessing.Value("i", 0)
+    stop = multiprocessing.Event()
+    stub = multiprocessing.Process(
+        target=_serve_stub_process,
+        args=(players, max_games, seed, api.requests, latency, port, stop),
+        daemon=True,
+    )
+    stub.start()
+    while not port.value:
+        if not stub.is_alive():
+            raise RuntimeError("The stub API failed to start")
+        time.sleep(0.05)
+    sys.path.insert(0, str(APP_PATH.parent))
+    from bai import bai
+
+    # The API url is read when bai.bai is imported, which may have happened already
+    bai.API_URL = f"http://127.0.0.1:{port.value}"
+    if cache_dir is not None:
+        bai.CACHE_DIR = cache_dir
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.perf_counter()
+    # The app prints to stdout, keep it for the report
+    with contextlib.redirect_stdout(sys.stderr), ThreadPoolExecutor(
+        max_workers=sessions
+    ) as executor:
+        results = executor.map(
+            lambda session: run_session(api, runs, seed + session, timeout),
+            range(sessions),
+        )
+        latencies = sorted(latency for result in results for latency in result)
+    wall = time.perf_counter() - wall_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    stop.set()
+    stub.join()
+    stub_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (
+        usage_end.ru_stime - usage_start.ru_stime
+    )
+    if len(latencies) < 2:
+        percentiles = latencies * 99
+    else:
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "sessions": sessions,
+        "runs": len(latencies),
+        "p50_s": percentiles[49],
+        "p95_s": percentiles[94],
+        "p99_s": percentiles[98],
+        "max_s": latencies[-1],
+        "throughput_runs_per_s": len(latencies) / wall,
+        "wall_s": wall,
+        "cpu_s": cpu,
+        "cpu_cores": cpu / wall,
+        "rss_mb": current_rss_mb(),
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": usage_end.ru_maxrss / 1024,
+        "api_requests": api.requests.value,
+        "stub_cpu_s": stub_usage.ru_utime + stub_usage.ru_stime,
+    }
+
+
+def main() -> None:
+    """Command line entry point of the load test"""
+    parser = argparse.ArgumentParser(description="Load test the streamlit app")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent viewers")
+    parser.add_argument("--runs", type=int, default=3, help="app runs per viewer")
+    parser.add_argument("--players", type=int, default=50, help="players in the stub")
+    parser.add_argument(
+        "--max-games", type=int, default=300, help="most games of a stub player"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="stub API latency in seconds"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=300.0, help="timeout of one app run"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="directory of the request caches, a fresh one by default",
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args = parser.parse_args()
+
+    # Never fill the app's own request caches with stub responses
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="bai-loadtest-")
+
+    report = load_test(
+        args.sessions,
+        args.runs,
+        args.players,
+        args.max_games,
+        args.latency,
+        args.timeout,
+        args.seed,
+        cache_dir,
+    )
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(
+            f"{key:>22}: {value:.3f}"
+            if isinstance(value, float)
+            else f"{key:>22}: {value}"
+        )
+
+
+if __name__ == "__main__":
+    main()